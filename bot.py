@@ -1,14 +1,16 @@
+import hashlib
 import logging
-import json
+import logging.handlers
 import os
-import requests
+import queue
 import time
-import re
 import aiohttp
 import asyncio
+from collections import OrderedDict, defaultdict
 from typing import Optional
 from datetime import datetime
-from telegram import Update
+from telegram import MessageEntity, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -17,13 +19,76 @@ from telegram.ext import (
     ContextTypes
 )
 
-OLLAMA_URL = "http://127.0.0.1:11434/api/chat"
-MODEL_NAME = "deepseek-r1:8b"
+try:
+    import orjson
+except ImportError:
+    import json
+
+    class orjson:
+        """Stdlib stand-in for the subset of orjson used here"""
+        JSONDecodeError = json.JSONDecodeError
+        OPT_INDENT_2 = 1
+
+        @staticmethod
+        def loads(data):
+            return json.loads(data)
+
+        @staticmethod
+        def dumps(obj, option=0) -> bytes:
+            return json.dumps(obj, ensure_ascii=False, indent=2 if option else None).encode()
+
+def env_number(name, default, minimum, maximum, cast=float):
+    """Read a numeric setting from the environment, refusing to start on a bad value"""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        raise SystemExit(f"{name} must be a number, got {raw!r}") from None
+    if not minimum <= value <= maximum:
+        raise SystemExit(f"{name} must be between {minimum} and {maximum}, got {value}")
+    return value
+
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434/api/chat")
+# Public HTTPS base URL for webhook mode; long polling is used when unset
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = env_number("WEBHOOK_PORT", 8443, 1, 65535, int)
+# Used by chats that have not picked a model with /set_model
+DEFAULT_MODEL = os.environ.get("OLLAMA_MODEL", "deepseek-r1:8b")
+# Legacy single-file store, migrated into CONVERSATIONS_DIR on first start
 CONVERSATIONS_FILE = "conversations.json"
-MAX_CONVERSATION_TURNS = 10
+# One chat_<id>.jsonl transcript per chat plus a small index.json
+CONVERSATIONS_DIR = os.environ.get("CONVERSATIONS_DIR", "conversations")
+INDEX_FILE = os.path.join(CONVERSATIONS_DIR, "index.json")
+MAX_CONVERSATION_TURNS = env_number("MAX_CONVERSATION_TURNS", 10, 1, 1000, int)
+# Histories kept in memory; idle chats beyond this are reloaded from disk on demand
+MAX_CACHED_CHATS = 1000
+# Answers kept for chats that opted into /cache
+RESPONSE_CACHE_SIZE = 256
+# Turns of history sent with each prompt, changeable per chat with /set_history
+DEFAULT_HISTORY_TURNS = 3
+# Seconds to wait after a change before conversations are written to disk
+SAVE_DELAY = env_number("SAVE_DELAY", 10.0, 0.0, 3600.0)
+# Seconds an idle connection to Ollama is kept open for reuse
+OLLAMA_KEEPALIVE = 300
+# How long Ollama keeps the model (and its prompt cache) loaded after a reply
+MODEL_KEEP_ALIVE = os.environ.get("MODEL_KEEP_ALIVE", "30m")
+# Longest silence tolerated on the Ollama stream, which includes loading the model
+OLLAMA_READ_TIMEOUT = env_number("OLLAMA_READ_TIMEOUT", 300.0, 1.0, 3600.0)
+# Request bodies are encoded with orjson rather than aiohttp's stdlib json
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Bytes read from the Ollama stream per iteration
+STREAM_CHUNK_SIZE = 65536
+# Compact a transcript once it holds this many times the kept history
+COMPACT_FACTOR = 4
 # Telegram’s nominal max message length
 TELEGRAM_MAX_LEN = 4096
-UPDATE_INTERVAL = 1.2
+UPDATE_INTERVAL = env_number("UPDATE_INTERVAL", 1.2, 0.3, 60.0)
+# Minimum number of new characters before a streaming edit is worth sending
+MIN_EDIT_DELTA = 24
 
 # Set up main logger
 logging.basicConfig(
@@ -33,238 +98,867 @@ logging.basicConfig(
 
 # Set up raw data logger
 raw_logger = logging.getLogger('raw_data')
-raw_logger.setLevel(logging.INFO)
+# RAW_LOG_LEVEL=WARNING turns off the full prompt/response dumps
+raw_logger.setLevel(os.environ.get("RAW_LOG_LEVEL", "INFO"))
 raw_handler = logging.FileHandler('raw_conversation_data.log')
 raw_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-raw_logger.addHandler(raw_handler)
+# File writes happen on the listener's thread, not the event loop
+raw_queue = queue.Queue()
+raw_logger.addHandler(logging.handlers.QueueHandler(raw_queue))
+raw_listener = logging.handlers.QueueListener(raw_queue, raw_handler)
+raw_listener.start()
+
+# chat_id -> list of turns, loaded lazily from the chat's transcript and
+# kept in least-recently-used order
+conversations = OrderedDict()
+# chat_id -> {"last_activity": ..., "msg_count": ...}
+chat_index = {}
+# chat_id -> rendered Ollama messages, one per turn in conversations[chat_id]
+prompt_cache = {}
+
+# Serialises generations within a chat so overlapping messages don't clobber each other
+chat_locks = defaultdict(asyncio.Lock)
+
+# sha256 of the request body -> (thinking, public) for chats with /cache on,
+# in least-recently-used order
+response_cache = OrderedDict()
+
+# Per-chat time.monotonic() deadline before which edits are suspended after a 429
+chat_throttle_until = {}
 
-conversations = {}
+# Turns not yet appended to their transcript, chats whose transcript must be
+# truncated first, whether only the index changed, and the pending debounced write
+pending_turns = {}
+reset_chats = set()
+index_dirty = False
+# Chats whose changes are being written by the current flush
+saving_chats = set()
+save_task: Optional[asyncio.Task] = None
+save_lock = asyncio.Lock()
+
+# Shared HTTP session for Ollama, created once the application starts
+http_session: Optional[aiohttp.ClientSession] = None
 
 class MessageState:
+    """
+    Raw text last delivered to the thinking and public messages, whether that
+    delivery only showed part of it (a streaming preview or a first chunk), and
+    how many overflow messages the final update has sent so a retry can resume.
+    """
     def __init__(self):
         self.last_thinking = ""
         self.last_public = ""
+        self.thinking_truncated = False
+        self.public_truncated = False
+        self.thinking_overflow_sent = 0
+        self.public_overflow_sent = 0
 
-def build_prompt(conversation):
-    """Build the prompt with clearer instructions about thinking tags"""
-    messages = [
-        {
-            "role": "system",
-            "content": "You are a helpful assistant. Keep your thinking concise and focused on the current task. Use <think> tags only for current reasoning, not for recapping previous context."
+def should_edit(last_sent: str, text: str, final: bool = False) -> bool:
+    """Skip edits that would not change the message or only add a few characters"""
+    # Telegram strips surrounding whitespace, so whitespace-only growth would
+    # come back as "message is not modified"
+    if text.strip() == last_sent.strip():
+        return False
+    return final or len(text) - len(last_sent) >= MIN_EDIT_DELTA
+
+SYSTEM_PROMPT = "You are a helpful assistant. Keep your thinking concise and focused on the current task. Use <think> tags only for current reasoning, not for recapping previous context."
+
+def render_turn(turn):
+    """Convert a stored turn into an Ollama chat message"""
+    if turn["role"] == "user":
+        return {
+            "role": "user",
+            "content": turn["content"]
         }
-    ]
-    
-    for turn in conversation[-6:]:
-        if turn["role"] == "user":
-            messages.append({
-                "role": "user", 
-                "content": turn["content"]
-            })
-        else:
-            # For assistant turns, reconstruct with thinking tags if present
-            thinking = turn.get("thinking", "").strip()
-            response = turn.get("content", "").strip()
-            content = f"<think>{thinking}</think>\n{response}" if thinking else response
-            messages.append({
-                "role": "assistant",
-                "content": content
-            })
+    # For assistant turns, reconstruct with thinking tags if present
+    thinking = turn.get("thinking", "").strip()
+    response = turn.get("content", "").strip()
+    content = f"<think>{thinking}</think>\n{response}" if thinking else response
+    return {
+        "role": "assistant",
+        "content": content
+    }
+
+def rendered_turns(chat_id):
+    """Ollama messages for a chat, rendering only turns added since the last call"""
+    conversation = get_conversation(chat_id)
+    rendered = prompt_cache.setdefault(chat_id, [])
+    if len(rendered) > len(conversation):
+        rendered.clear()
+    for turn in conversation[len(rendered):]:
+        rendered.append(render_turn(turn))
+    return rendered
+
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Sampling options sent with every request
+MODEL_OPTIONS = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "num_predict": 1000
+}
+
+def build_prompt(rendered, history_turns=DEFAULT_HISTORY_TURNS):
+    """Build the prompt with clearer instructions about thinking tags"""
+    # Previous turns plus the current user message, which is always sent
+    messages = [SYSTEM_MESSAGE, *rendered[max(0, len(rendered) - history_turns * 2 - 1):]]
     
     # For Ollama API
     payload = {
         "messages": messages,
         "stream": True,
-        "options": {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "num_predict": 1000
-        }
+        "keep_alive": MODEL_KEEP_ALIVE,
+        "options": MODEL_OPTIONS
     }
     
     return payload
 
-def escape_markdown_v2(text: str) -> str:
-    escape_chars = r'_*[]()~`>#+-={}.!'
-    for c in escape_chars:
-        text = text.replace(c, "\\" + c)
-    return text
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+def partial_tag_len(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that could be the start of tag"""
+    # Both tags contain "<" only as their first character, so the only
+    # candidate suffix starts at the last "<" within reach of the end
+    idx = text.rfind("<", max(0, len(text) - len(tag) + 1))
+    if idx != -1 and tag.startswith(text[idx:]):
+        return len(text) - idx
+    return 0
+
+class ThinkParser:
+    """
+    Incrementally splits streamed model output into thinking and public text.
+    Each call to feed() only scans the new tokens; a tag split across two
+    chunks is held back until the next chunk completes it.
+    """
+    def __init__(self):
+        self.state = "outsideThink"
+        self._pending = ""
+        self._thinking_parts = []
+        self._public_parts = []
+
+    def feed(self, tokens: str):
+        # Most chunks hold no tag and no partial tag: route them without scanning
+        if not self._pending and "<" not in tokens:
+            if tokens:
+                target = self._thinking_parts if self.state == "insideThink" else self._public_parts
+                target.append(tokens)
+            return
+        text = self._pending + tokens
+        self._pending = ""
+        i = 0
+        while i < len(text):
+            if self.state == "afterThink":
+                self._public_parts.append(text[i:])
+                return
+
+            if self.state == "outsideThink":
+                tag, target, next_state = THINK_OPEN, self._public_parts, "insideThink"
+            else:
+                tag, target, next_state = THINK_CLOSE, self._thinking_parts, "afterThink"
+
+            idx = text.find(tag, i)
+            if idx == -1:
+                keep = partial_tag_len(text[i:], tag)
+                end = len(text) - keep
+                if end > i:
+                    target.append(text[i:end])
+                self._pending = text[end:]
+                return
+
+            if idx > i:
+                target.append(text[i:idx])
+            self.state = next_state
+            i = idx + len(tag)
+
+    def close(self):
+        """Flush a held-back partial tag once the stream has ended"""
+        if self._pending:
+            target = self._thinking_parts if self.state == "insideThink" else self._public_parts
+            target.append(self._pending)
+            self._pending = ""
+
+    @staticmethod
+    def _joined(parts) -> str:
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    @property
+    def thinking(self) -> str:
+        return self._joined(self._thinking_parts)
+
+    @property
+    def public(self) -> str:
+        return self._joined(self._public_parts)
+
+# Label shown in bold above the chain-of-thought spoiler
+THINKING_LABEL = "Thinking:"
+
+def utf16_len(text: str) -> int:
+    """Length in UTF-16 code units, the unit Telegram uses for entity offsets"""
+    return len(text.encode("utf-16-le")) // 2
+
+def thinking_chunks(thinking: str, max_len: int = TELEGRAM_MAX_LEN):
+    """
+    Split the chain of thought into (text, entities) messages: a bold label,
+    then the thinking itself hidden behind a spoiler entity.
+    Entities avoid MarkdownV2 parse mode, so nothing has to be escaped.
+    """
+    header = THINKING_LABEL + "\n"
+    first_len = max_len - len(header)
+    bodies = [thinking[:first_len]] + chunk_text(thinking[first_len:], max_len)
+    messages = []
+    for i, body in enumerate(bodies):
+        if not body:
+            continue
+        prefix = header if i == 0 else ""
+        entities = [MessageEntity(MessageEntity.SPOILER, len(prefix), utf16_len(body))]
+        if prefix:
+            entities.insert(0, MessageEntity(MessageEntity.BOLD, 0, len(THINKING_LABEL)))
+        messages.append((prefix + body, entities))
+    return messages
 
 def chunk_text(text: str, max_len: int = TELEGRAM_MAX_LEN):
-    chunks = []
-    idx = 0
-    while idx < len(text):
-        end = idx + max_len
-        chunks.append(text[idx:end])
-        idx = end
-    return chunks
+    return [text[i:i + max_len] for i in range(0, len(text), max_len)]
 
 def trim_conversation(conversation, max_turns=MAX_CONVERSATION_TURNS):
     """
     Keep only the last N turns while ensuring we don't break in the middle of a turn.
     A turn consists of a user message and the assistant's response.
+    Trims in place so the list keeps its identity, and returns how many entries were dropped.
     """
     if len(conversation) <= max_turns * 2:
-        return conversation
+        return 0
         
     # Ensure we start with a user message when trimming
     start_idx = len(conversation) - (max_turns * 2)
     while start_idx > 0 and conversation[start_idx]["role"] != "user":
         start_idx -= 1
         
-    return conversation[start_idx:]
+    del conversation[:start_idx]
+    return start_idx
+
+def validate_turns(convo):
+    """Keep only well-formed turns, normalising assistant turns"""
+    valid_convo = []
+    for turn in convo:
+        if isinstance(turn, dict) and "role" in turn:
+            if turn["role"] == "user" and "content" in turn:
+                valid_convo.append(turn)
+            elif turn["role"] == "assistant" and "content" in turn:
+                # Assistant turns can have both content and thinking
+                valid_convo.append({
+                    "role": "assistant",
+                    "content": turn.get("content", ""),
+                    "thinking": turn.get("thinking", "")
+                })
+    return valid_convo
+
+def transcript_path(chat_id):
+    return os.path.join(CONVERSATIONS_DIR, f"chat_{chat_id}.jsonl")
+
+def read_transcript(chat_id):
+    """Read one chat's JSONL transcript, skipping corrupt lines"""
+    turns = []
+    try:
+        with open(transcript_path(chat_id), "rb") as f:
+            for line in f:
+                try:
+                    turns.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    except IOError as e:
+        logging.warning(f"Could not load transcript for chat {chat_id}: {e}")
+    return validate_turns(turns)
+
+def get_conversation(chat_id):
+    """Return the in-memory conversation, reading its transcript on first use"""
+    conversation = conversations.get(chat_id)
+    if conversation is None:
+        conversation = read_transcript(chat_id) if chat_id in chat_index else []
+        trim_conversation(conversation)
+        evict_idle_conversations()
+        conversations[chat_id] = conversation
+    else:
+        conversations.move_to_end(chat_id)
+    return conversation
+
+def evict_idle_conversations():
+    """Make room for one more history by dropping the least recently used idle ones"""
+    excess = len(conversations) + 1 - MAX_CACHED_CHATS
+    if excess <= 0:
+        return
+    idle = []
+    for chat_id in conversations:
+        if len(idle) == excess:
+            break
+        # Unsaved or still-writing changes and running replies need the in-memory copy
+        lock = chat_locks.get(chat_id)
+        if chat_id in pending_turns or chat_id in reset_chats or chat_id in saving_chats or (lock and lock.locked()):
+            continue
+        idle.append(chat_id)
+    for chat_id in idle:
+        del conversations[chat_id]
+        prompt_cache.pop(chat_id, None)
+        chat_locks.pop(chat_id, None)
+        # Rate limiter state is keyed by the numeric chat id
+        forget_rate_limits(int(chat_id))
+
+def migrate_legacy_conversations():
+    """Split the old single conversations.json into per-chat transcripts"""
+    try:
+        with open(CONVERSATIONS_FILE, "rb") as f:
+            loaded = orjson.loads(f.read())
+    except (orjson.JSONDecodeError, IOError) as e:
+        logging.warning(f"Could not load {CONVERSATIONS_FILE}: {e}")
+        return
+    now = time.time()
+    for chat_id, convo in loaded.items():
+        conversations[chat_id] = validate_turns(convo)
+        pending_turns[chat_id] = list(conversations[chat_id])
+        reset_chats.add(chat_id)
+        chat_index[chat_id] = {"last_activity": now, "msg_count": len(conversations[chat_id])}
+    write_pending(pending_turns, reset_chats, chat_index)
+    pending_turns.clear()
+    reset_chats.clear()
+    os.replace(CONVERSATIONS_FILE, CONVERSATIONS_FILE + ".migrated")
+    logging.info(f"Migrated {len(loaded)} chats from {CONVERSATIONS_FILE}")
 
 def load_conversations():
-    """Load conversations from disk with validation"""
-    global conversations
-    if os.path.exists(CONVERSATIONS_FILE):
+    """Load the chat index; transcripts are read on demand"""
+    global chat_index
+    if os.path.exists(INDEX_FILE):
         try:
-            with open(CONVERSATIONS_FILE, "r", encoding="utf-8") as f:
-                loaded = json.load(f)
-                # Validate conversation structure with enhanced checks
-                for chat_id, convo in loaded.items():
-                    valid_convo = []
-                    expected_role = "user"
-                    for turn in convo:
-                        if isinstance(turn, dict) and "role" in turn:
-                            if turn["role"] == "user" and "content" in turn:
-                                valid_convo.append(turn)
-                                expected_role = "assistant"
-                            elif turn["role"] == "assistant" and "content" in turn:
-                                # Assistant turns can have both content and thinking
-                                valid_turn = {
-                                    "role": "assistant",
-                                    "content": turn.get("content", ""),
-                                    "thinking": turn.get("thinking", "")
-                                }
-                                valid_convo.append(valid_turn)
-                                expected_role = "user"
-                    loaded[chat_id] = valid_convo
-                conversations = loaded
-        except (json.JSONDecodeError, IOError) as e:
-            logging.warning(f"Could not load conversations.json: {e}")
-            conversations = {}
+            with open(INDEX_FILE, "rb") as f:
+                chat_index = orjson.loads(f.read())
+        except (orjson.JSONDecodeError, IOError) as e:
+            logging.warning(f"Could not load {INDEX_FILE}: {e}")
+            chat_index = {}
+    elif os.path.exists(CONVERSATIONS_FILE):
+        migrate_legacy_conversations()
+
+def write_transcript(chat_id, turns):
+    """Rewrite a whole transcript via a temp file and an atomic rename"""
+    path = transcript_path(chat_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.writelines(orjson.dumps(turn) + b"\n" for turn in turns)
+    os.replace(tmp_path, path)
+
+def write_pending(turns_by_chat, resets, index_snapshot, compacted=None, written=None):
+    """
+    Append new turns to transcripts and atomically replace the index.
+    Chats in `compacted` have their transcript rewritten from the given turns instead.
+    Each chat is added to `written` once its transcript is complete, so a failed
+    write only has to be retried for the others.
+    """
+    compacted = compacted or {}
+    written = set() if written is None else written
+    os.makedirs(CONVERSATIONS_DIR, exist_ok=True)
+    for chat_id in resets:
+        if chat_id not in compacted:
+            open(transcript_path(chat_id), "wb").close()
+            if chat_id not in turns_by_chat:
+                written.add(chat_id)
+    for chat_id, turns in compacted.items():
+        write_transcript(chat_id, turns)
+        written.add(chat_id)
+    for chat_id, turns in turns_by_chat.items():
+        if chat_id in compacted:
+            continue
+        with open(transcript_path(chat_id), "a+b") as f:
+            # A crash mid-append leaves a torn last line; end it so the new turns
+            # don't get glued onto it and become unreadable too
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.writelines(orjson.dumps(turn) + b"\n" for turn in turns)
+        written.add(chat_id)
+    tmp_path = INDEX_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(index_snapshot))
+    os.replace(tmp_path, INDEX_FILE)
+
+async def flush_conversations():
+    """Write pending changes to disk without blocking the event loop"""
+    global pending_turns, reset_chats, index_dirty
+    async with save_lock:
+        if not pending_turns and not reset_chats and not index_dirty:
+            return
+        turns_by_chat, resets = pending_turns, reset_chats
+        pending_turns, reset_chats, index_dirty = {}, set(), False
+        # Transcripts only ever grow; once one holds far more than the kept
+        # window, rewrite it from the trimmed in-memory history
+        compacted = {}
+        for chat_id in turns_by_chat:
+            entry = chat_index[chat_id]
+            if entry["msg_count"] > MAX_CONVERSATION_TURNS * 2 * COMPACT_FACTOR:
+                compacted[chat_id] = list(conversations[chat_id])
+                entry["msg_count"] = len(compacted[chat_id])
+        index_snapshot = {chat_id: dict(entry) for chat_id, entry in chat_index.items()}
+        # The changes are out of pending_turns now, so keep these chats from eviction until written
+        saving_chats.update(turns_by_chat, resets)
+        written = set()
+        try:
+            await asyncio.to_thread(write_pending, turns_by_chat, resets, index_snapshot, compacted, written)
+        except OSError as e:
+            logging.error(f"Could not save conversations: {e}")
+            # Put the unsaved changes back in front of anything queued meanwhile;
+            # transcripts already written would otherwise get the same turns twice
+            for chat_id, turns in turns_by_chat.items():
+                if chat_id not in written and chat_id not in reset_chats:
+                    pending_turns[chat_id] = turns + pending_turns.get(chat_id, [])
+            reset_chats |= resets - written
+            index_dirty = True
+        finally:
+            saving_chats.clear()
+
+async def delayed_save():
+    global save_task
+    await asyncio.sleep(SAVE_DELAY)
+    save_task = None
+    await flush_conversations()
+
+def schedule_save():
+    global save_task
+    if save_task is None:
+        save_task = asyncio.create_task(delayed_save())
+
+def append_turn(chat_id, turn):
+    """Add a turn to the chat and queue it for appending to its transcript"""
+    conversation = get_conversation(chat_id)
+    conversation.append(turn)
+    removed = trim_conversation(conversation)
+    if removed and chat_id in prompt_cache:
+        del prompt_cache[chat_id][:removed]
+    pending_turns.setdefault(chat_id, []).append(turn)
+    entry = chat_index.setdefault(chat_id, {"msg_count": 0})
+    entry["last_activity"] = time.time()
+    entry["msg_count"] += 1
+    schedule_save()
+
+def reset_conversation(chat_id):
+    """Forget a chat's history and truncate its transcript on the next write"""
+    conversations[chat_id] = []
+    prompt_cache.pop(chat_id, None)
+    pending_turns.pop(chat_id, None)
+    reset_chats.add(chat_id)
+    # Settings survive a reset
+    entry = chat_index.setdefault(chat_id, {})
+    entry["last_activity"] = time.time()
+    entry["msg_count"] = 0
+    schedule_save()
+
+def cache_response(key, value):
+    """Remember an answer for an identical request, dropping the least recently used"""
+    response_cache[key] = value
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+def chat_settings(chat_id):
+    """Per-chat settings such as the model, stored alongside the chat's index entry"""
+    return chat_index.get(chat_id, {}).get("settings", {})
+
+def update_chat_setting(chat_id, key, value):
+    global index_dirty
+    entry = chat_index.setdefault(chat_id, {"last_activity": time.time(), "msg_count": 0})
+    entry.setdefault("settings", {})[key] = value
+    index_dirty = True
+    schedule_save()
+
+class TokenBucket:
+    """Async token bucket refilled at `rate` tokens per second up to `capacity`"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def has_token(self) -> bool:
+        """Whether a token is available right now, without taking it"""
+        self._refill()
+        return self.tokens >= 1
+
+    def is_full(self) -> bool:
+        """Whether the bucket has refilled, making it no different from a new one"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right now"""
+        if self.has_token():
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Telegram allows roughly 30 messages per second per bot, 1 per second per chat
+# and 20 per minute in groups
+global_bucket = TokenBucket(rate=30, capacity=30)
+chat_buckets = {}
+
+def chat_bucket(chat_id) -> TokenBucket:
+    """Return the rate limiter for a chat, sized by whether it is a group"""
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        # Group and channel ids are negative
+        if int(chat_id) < 0:
+            bucket = TokenBucket(rate=20 / 60, capacity=20)
+        else:
+            bucket = TokenBucket(rate=1, capacity=3)
+        chat_buckets[chat_id] = bucket
+    return bucket
+
+def forget_rate_limits(chat_id):
+    """Drop a chat's limiter and flood-control state once it no longer limits anything"""
+    bucket = chat_buckets.get(chat_id)
+    if bucket is not None and bucket.is_full():
+        del chat_buckets[chat_id]
+    if chat_throttle_until.get(chat_id, 0.0) <= time.monotonic():
+        chat_throttle_until.pop(chat_id, None)
+
+async def acquire_send_slot(chat_id, wait=True) -> bool:
+    """
+    Pace outgoing Telegram calls under the bot-wide and per-chat limits.
+    With wait=False a call that would exceed a limit is refused instead of delayed.
+    """
+    bucket = chat_bucket(chat_id)
+    if wait:
+        await global_bucket.acquire()
+        await bucket.acquire()
+        return True
+    # Check both before taking from either, so a refusal doesn't waste a token
+    if not (bucket.has_token() and global_bucket.has_token()):
+        return False
+    bucket.try_acquire()
+    global_bucket.try_acquire()
+    return True
+
+async def send_waiting_out_flood(chat_id, send):
+    """Send a new message; these can't be dropped like edits, so wait out flood control once"""
+    await acquire_send_slot(chat_id)
+    try:
+        return await send()
+    except RetryAfter as e:
+        delay = retry_after_seconds(e)
+        chat_throttle_until[chat_id] = time.monotonic() + delay
+        await asyncio.sleep(delay)
+        return await send()
+
+async def safe_send(chat, text, entities=None):
+    return await send_waiting_out_flood(chat.id, lambda: chat.send_message(text, entities=entities))
+
+async def safe_reply(message, text):
+    return await send_waiting_out_flood(message.chat_id, lambda: message.reply_text(text))
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+async def safe_edit(msg, text, entities=None, wait=False):
+    """
+    Edit a message unless its chat is under Telegram flood control.
+    With wait=True the edit is delayed until the flood deadline instead of skipped.
+    Returns True if the edit went through.
+    """
+    chat_id = msg.chat_id
+    remaining = chat_throttle_until.get(chat_id, 0.0) - time.monotonic()
+    if remaining > 0:
+        if not wait:
+            return False
+        await asyncio.sleep(remaining)
+    if not await acquire_send_slot(chat_id, wait=wait):
+        return False
+    try:
+        await msg.edit_text(text, entities=entities)
+    except RetryAfter as e:
+        delay = retry_after_seconds(e)
+        chat_throttle_until[chat_id] = time.monotonic() + delay
+        logging.warning(f"Flood control in chat {chat_id}, suspending edits for {delay:.0f}s")
+        if not wait:
+            return False
+        await asyncio.sleep(delay)
+        await msg.edit_text(text, entities=entities)
+    return True
+
+def stream_preview(text: str, max_len: int = TELEGRAM_MAX_LEN) -> str:
+    """
+    Latest part of a still-growing text that fits in one message, with a
+    leading ellipsis when cut. Overflow messages are only sent with the final update.
+    """
+    if len(text) <= max_len:
+        return text
+    return "…" + text[-(max_len - 1):]
+
+async def edit_if_changed(msg, text, entities=None, wait=False):
+    """safe_edit that counts "Message is not modified" as delivered"""
+    try:
+        return await safe_edit(msg, text, entities=entities, wait=wait)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+        return True
+
+async def update_thinking(update, msg_state, chain_of_thought_msg, thinking, final=False):
+    # A truncated message is completed by the final update even if the text stopped growing
+    changed = should_edit(msg_state.last_thinking, thinking, final) or (final and msg_state.thinking_truncated)
+    if not (chain_of_thought_msg and thinking and changed):
+        return
+    preview_len = TELEGRAM_MAX_LEN - len(THINKING_LABEL) - 1
+    if final:
+        chunks = thinking_chunks(thinking)
     else:
-        conversations = {}
-
-def save_conversations():
-    """Save conversations to disk"""
-    with open(CONVERSATIONS_FILE, "w", encoding="utf-8") as f:
-        json.dump(conversations, f, ensure_ascii=False, indent=2)
-
-async def update_messages(update, chain_of_thought_msg, public_msg, inside_buffer, outside_buffer, after_buffer):
-    if chain_of_thought_msg and inside_buffer:
-        escaped = escape_markdown_v2(inside_buffer)
-        spoiler_text = f"||{escaped}||"
-        chunks = chunk_text(spoiler_text, TELEGRAM_MAX_LEN)
+        chunks = thinking_chunks(stream_preview(thinking, preview_len))
+    try:
+        text, entities = chunks[0]
+        if await edit_if_changed(chain_of_thought_msg, text, entities=entities, wait=final):
+            # Only count the text as delivered once every overflow message is out
+            for text, entities in chunks[1 + msg_state.thinking_overflow_sent:]:
+                await safe_send(update.effective_chat, text, entities=entities)
+                msg_state.thinking_overflow_sent += 1
+            msg_state.last_thinking = thinking
+            msg_state.thinking_truncated = not final and len(thinking) > preview_len
+    except BadRequest as e:
+        logging.error(f"Error updating thinking: {e}")
+    except NetworkError as e:
+        # Transient; the final update is retried by the caller
+        if final:
+            raise
+        logging.warning(f"Network error updating thinking: {e}")
+
+async def update_public(update, msg_state, public_msg, public, final=False):
+    """Edit the public message, returning it or the message that replaced it"""
+    changed = should_edit(msg_state.last_public, public, final) or (final and msg_state.public_truncated)
+    if not (public_msg and public.strip() and changed):
+        return public_msg
+    chunks = chunk_text(public) if final else [stream_preview(public)]
+    try:
         try:
-            if len(chunks) == 1:
-                await chain_of_thought_msg.edit_text(chunks[0], parse_mode="MarkdownV2")
-            else:
-                await chain_of_thought_msg.edit_text(chunks[0], parse_mode="MarkdownV2")
-                for chunk in chunks[1:]:
-                    await update.effective_chat.send_message(chunk, parse_mode="MarkdownV2")
-        except Exception as e:
-            if "Message is not modified" not in str(e):
-                logging.error(f"Error updating thinking: {e}")
-
-    if public_msg:
-        current_public = outside_buffer + after_buffer
-        if current_public.strip():
-            chunks = chunk_text(current_public)
+            delivered = await edit_if_changed(public_msg, chunks[0], wait=final)
+        except BadRequest as e:
+            if "Message to edit not found" not in str(e):
+                raise
+            logging.error(f"Error updating public: {e}")
+            # Continue in a new message so later updates don't resend it every tick
             try:
-                if len(chunks) == 1:
-                    await public_msg.edit_text(chunks[0])
-                else:
-                    await public_msg.edit_text(chunks[0])
-                    for chunk in chunks[1:]:
-                        await update.effective_chat.send_message(chunk)
-            except Exception as e:
-                if "Message is not modified" not in str(e):
-                    logging.error(f"Error updating public: {e}")
-                    if "Message to edit not found" in str(e):
-                        try:
-                            public_msg = await update.effective_chat.send_message(current_public)
-                        except Exception as send_error:
-                            logging.error(f"Error sending new message: {send_error}")
+                public_msg = await safe_send(update.effective_chat, chunks[0])
+            except TelegramError as send_error:
+                logging.error(f"Error sending new message: {send_error}")
+                return public_msg
+            delivered = True
+        if delivered:
+            for chunk in chunks[1 + msg_state.public_overflow_sent:]:
+                await safe_send(update.effective_chat, chunk)
+                msg_state.public_overflow_sent += 1
+            msg_state.last_public = public
+            msg_state.public_truncated = not final and len(public) > TELEGRAM_MAX_LEN
+    except BadRequest as e:
+        logging.error(f"Error updating public: {e}")
+    except NetworkError as e:
+        if final:
+            raise
+        logging.warning(f"Network error updating public: {e}")
+    return public_msg
+
+async def update_messages(update, msg_state, chain_of_thought_msg, public_msg, thinking, public, final=False):
+    """
+    Edit the thinking and public messages, concurrently while streaming.
+    The final update runs them in order so overflow messages don't interleave.
+    Returns the public message, which is replaced if it was deleted.
+    """
+    if final:
+        await update_thinking(update, msg_state, chain_of_thought_msg, thinking, final)
+        return await update_public(update, msg_state, public_msg, public, final)
+    results = await asyncio.gather(
+        update_thinking(update, msg_state, chain_of_thought_msg, thinking),
+        update_public(update, msg_state, public_msg, public),
+        return_exceptions=True
+    )
+    # Only raise once both edits are done
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results[1]
+
+async def iter_ndjson_lines(response):
+    """Yield complete NDJSON lines from a streamed response, reading it in large chunks"""
+    buffer = b""
+    async for data in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
 
 # ----------------------------------------------------
 # MAIN MESSAGE HANDLER
 # ----------------------------------------------------
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
+    # One generation per chat at a time; other chats proceed concurrently
+    async with chat_locks[chat_id]:
+        await generate_reply(update, chat_id)
+
+async def generate_reply(update: Update, chat_id: str):
     user_text = update.message.text
 
-    conversation = conversations.get(chat_id, [])
-    conversation.append({"role": "user", "content": user_text})
+    append_turn(chat_id, {"role": "user", "content": user_text})
 
-    thinking_header_msg = await update.message.reply_text("Thinking...")
+    thinking_header_msg = await safe_reply(update.message, "Thinking...")
 
     chain_of_thought_msg = None
     public_msg = None
+    msg_state = MessageState()
     complete_response_received = False
     
-    state = "outsideThink"
-    outside_buffer = ""
-    inside_buffer = ""
-    after_buffer = ""
-    full_response = ""
-    last_update_time = time.time()
+    parser = ThinkParser()
+    raw_parts = []
+    tokens_fed = 0
+    stream_done = asyncio.Event()
+
+    settings = chat_settings(chat_id)
+    payload = build_prompt(rendered_turns(chat_id), settings.get("history", DEFAULT_HISTORY_TURNS))
+    payload["model"] = settings.get("model", DEFAULT_MODEL)
 
-    payload = build_prompt(conversation[-6:])
-    payload["model"] = MODEL_NAME
+    body = orjson.dumps(payload)
+    cache_key = hashlib.sha256(body).hexdigest() if settings.get("cache") else None
+    cached = response_cache.get(cache_key) if cache_key else None
 
-    # Log raw prompt
-    raw_logger.info(f"PAYLOAD [chat_id={chat_id}]:\n{json.dumps(payload, indent=2)}\n")
+    # Log raw prompt; the raw response is only collected when it will be logged
+    log_raw = raw_logger.isEnabledFor(logging.INFO)
+    if log_raw:
+        raw_logger.info(f"PAYLOAD [chat_id={chat_id}]:\n{body.decode()}\n")
 
-    async def ensure_messages_sent():
+    async def claim_or_send(text, entities=None, final=False):
+        """Turn the "Thinking..." placeholder into the first real message, send any later ones"""
+        nonlocal thinking_header_msg
+        if thinking_header_msg is None:
+            return await safe_send(update.effective_chat, text, entities=entities)
+        msg = thinking_header_msg
+        if not await safe_edit(msg, text, entities=entities, wait=final):
+            return None
+        thinking_header_msg = None
+        return msg
+
+    async def report_error(text):
+        if thinking_header_msg is not None:
+            await safe_edit(thinking_header_msg, text, wait=True)
+        else:
+            await safe_send(update.effective_chat, text)
+
+    async def ensure_messages_sent(final=False):
         nonlocal public_msg, chain_of_thought_msg
         
-        if inside_buffer.strip():
+        thinking = parser.thinking
+        if thinking.strip():
             if not chain_of_thought_msg:
                 try:
-                    escaped = escape_markdown_v2(inside_buffer)
-                    chain_of_thought_msg = await update.effective_chat.send_message(
-                        f"||{escaped}||",
-                        parse_mode="MarkdownV2"
-                    )
-                except Exception as e:
+                    chunks = thinking_chunks(thinking)
+                    text, entities = chunks[0]
+                    chain_of_thought_msg = await claim_or_send(text, entities=entities, final=final)
+                    if chain_of_thought_msg:
+                        # The rest is sent as overflow messages by the final update
+                        msg_state.last_thinking = thinking
+                        msg_state.thinking_truncated = len(chunks) > 1
+                except NetworkError as e:
+                    # Transient; the final send is retried by the caller
+                    if final:
+                        raise
+                    logging.error(f"Error sending thinking message: {e}")
+                except TelegramError as e:
                     logging.error(f"Error sending thinking message: {e}")
 
-        current_public = (outside_buffer + after_buffer).strip()
+        public = parser.public
+        current_public = public.strip()
         if current_public:
             if not public_msg:
                 try:
-                    public_msg = await update.effective_chat.send_message(current_public)
-                except Exception as e:
+                    chunks = chunk_text(current_public)
+                    public_msg = await claim_or_send(chunks[0], final=final)
+                    if public_msg:
+                        msg_state.last_public = public
+                        msg_state.public_truncated = len(chunks) > 1
+                except NetworkError as e:
+                    # Transient; the final send is retried by the caller
+                    if final:
+                        raise
+                    logging.error(f"Error sending public message: {e}")
+                except TelegramError as e:
                     logging.error(f"Error sending public message: {e}")
 
+    async def edit_loop():
+        """Push the latest parsed text to Telegram at most once per UPDATE_INTERVAL"""
+        nonlocal public_msg
+        last_seen = 0
+        while not stream_done.is_set():
+            # Sleep through Telegram flood control rather than waking to skipped edits
+            throttled = chat_throttle_until.get(update.effective_chat.id, 0.0) - time.monotonic()
+            try:
+                await asyncio.wait_for(stream_done.wait(), max(UPDATE_INTERVAL, throttled))
+            except asyncio.TimeoutError:
+                pass
+            if stream_done.is_set() or tokens_fed == last_seen:
+                continue
+            last_seen = tokens_fed
+            try:
+                await ensure_messages_sent()
+                public_msg = await update_messages(
+                    update,
+                    msg_state,
+                    chain_of_thought_msg,
+                    public_msg,
+                    parser.thinking,
+                    parser.public
+                )
+            except TelegramError as e:
+                logging.error(f"Error updating streamed messages: {e}")
+
+    # Token reads never wait on Telegram; intermediate edits run in the background
+    editor_task = asyncio.create_task(edit_loop())
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(OLLAMA_URL, json=payload) as response:
-                if response.status != 200:
-                    err_text = f"Error {response.status} from Ollama:\n{await response.text()}"
-                    await thinking_header_msg.edit_text(err_text)
-                    return
-
-                buffer = ""
-                async for line in response.content:
-                    try:
-                        if not line.strip():
-                            continue
-                            
-                        buffer += line.decode('utf-8')
-                        if not buffer.endswith('\n'):
-                            continue
-                            
-                        for chunk_line in buffer.splitlines():
-                            if not chunk_line.strip():
-                                continue
-                                
+        try:
+            if cached is not None:
+                # Replay the stored answer through the same parser and message updates
+                response_cache.move_to_end(cache_key)
+                thinking, public = cached
+                replay = THINK_OPEN + thinking + THINK_CLOSE + public
+                if log_raw:
+                    raw_parts.append(replay)
+                parser.feed(replay)
+                tokens_fed += 1
+            else:
+                async with http_session.post(OLLAMA_URL, data=body, headers=JSON_HEADERS) as response:
+                    if response.status != 200:
+                        err_text = f"Error {response.status} from Ollama:\n{await response.text()}"
+                        stream_done.set()
+                        await editor_task
+                        await report_error(err_text)
+                        return
+
+                    async for chunk_line in iter_ndjson_lines(response):
+                        try:
                             try:
-                                chunk = json.loads(chunk_line)
-                                # raw_logger.info(f"CHUNK:\n{json.dumps(chunk, indent=2)}\n")
-                            except json.JSONDecodeError:
+                                chunk = orjson.loads(chunk_line)
+                                # raw_logger.info(f"CHUNK:\n{orjson.dumps(chunk, option=orjson.OPT_INDENT_2).decode()}\n")
+                            except orjson.JSONDecodeError:
                                 continue
 
                             if "message" in chunk:
@@ -274,126 +968,138 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             else:
                                 continue
 
-                            full_response += new_tokens
-
-                            i = 0
-                            while i < len(new_tokens):
-                                if state == "outsideThink":
-                                    idx = new_tokens.find("<think>", i)
-                                    if idx == -1:
-                                        outside_buffer += new_tokens[i:]
-                                        i = len(new_tokens)
-                                    else:
-                                        outside_buffer += new_tokens[i:idx]
-                                        state = "insideThink"
-                                        i = idx + len("<think>")
-
-                                elif state == "insideThink":
-                                    end_idx = new_tokens.find("</think>", i)
-                                    if end_idx == -1:
-                                        inside_buffer += new_tokens[i:]
-                                        i = len(new_tokens)
-                                    else:
-                                        inside_buffer += new_tokens[i:end_idx]
-                                        state = "afterThink"
-                                        i = end_idx + len("</think>")
-
-                                else:
-                                    after_buffer += new_tokens[i:]
-                                    i = len(new_tokens)
-
-                            if time.time() - last_update_time > UPDATE_INTERVAL:
-                                await ensure_messages_sent()
-                                await update_messages(
-                                    update,
-                                    chain_of_thought_msg,
-                                    public_msg,
-                                    inside_buffer,
-                                    outside_buffer,
-                                    after_buffer
-                                )
-                                last_update_time = time.time()
-                                
-                        buffer = ""
-
-                    except Exception as e:
-                        raw_logger.error(f"Error processing chunk: {str(e)}\nChunk: {chunk_line}")
-                        continue
-
-                complete_response_received = True
-
-    except Exception as e:
+                            if log_raw:
+                                raw_parts.append(new_tokens)
+
+                            parser.feed(new_tokens)
+                            tokens_fed += 1
+
+                        except (KeyError, TypeError) as e:
+                            raw_logger.error(f"Error processing chunk: {str(e)}\nChunk: {chunk_line}")
+                            continue
+
+            parser.close()
+            complete_response_received = True
+        finally:
+            stream_done.set()
+            await editor_task
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError) as e:
         logging.error(f"Error in handle_message: {str(e)}")
-        await thinking_header_msg.edit_text(f"Error: {str(e)}")
+        await report_error(f"Error: {str(e)}")
         return
 
     # Log raw response
-    raw_logger.info(f"RESPONSE [chat_id={chat_id}]:\n{full_response}\n")
+    if log_raw:
+        raw_logger.info(f"RESPONSE [chat_id={chat_id}]:\n{''.join(raw_parts)}\n")
 
     try:
-        await ensure_messages_sent()
-        
         retry_count = 3
         for attempt in range(retry_count):
             try:
-                await update_messages(
+                await ensure_messages_sent(final=True)
+                public_msg = await update_messages(
                     update,
+                    msg_state,
                     chain_of_thought_msg,
                     public_msg,
-                    inside_buffer,
-                    outside_buffer,
-                    after_buffer
+                    parser.thinking,
+                    parser.public,
+                    final=True
                 )
                 break
-            except Exception as e:
+            except NetworkError as e:
                 if attempt == retry_count - 1:
                     logging.error(f"Final update failed after {retry_count} attempts: {e}")
                 await asyncio.sleep(0.5)
 
-    except Exception as e:
+    except TelegramError as e:
         logging.error(f"Error in final message handling: {e}")
 
     if complete_response_received:
-        final_content = (outside_buffer + after_buffer).strip()
-        if final_content or inside_buffer.strip():
-            conversation.append({
+        final_content = parser.public.strip()
+        final_thinking = parser.thinking.strip()
+        if final_content or final_thinking:
+            # An empty answer would be replayed instead of asking Ollama again
+            if cache_key and cached is None:
+                cache_response(cache_key, (parser.thinking, parser.public))
+            append_turn(chat_id, {
                 "role": "assistant",
-                "thinking": inside_buffer.strip(),
+                "thinking": final_thinking,
                 "content": final_content
             })
-            conversations[chat_id] = conversation
-            save_conversations()
 
-    try:
-        await thinking_header_msg.delete()
-    except Exception:
-        pass
+    # The placeholder is only left over if the model produced no text at all
+    if thinking_header_msg is not None:
+        try:
+            await thinking_header_msg.delete()
+        except TelegramError:
+            pass
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
-    conversations[chat_id] = []
-    save_conversations()
-    await update.message.reply_text("Conversation reset. Let's start fresh!")
+    async with chat_locks[chat_id]:
+        reset_conversation(chat_id)
+    await safe_reply(update.message, "Conversation reset. Let's start fresh!")
 
 async def set_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global MODEL_NAME
+    chat_id = str(update.effective_chat.id)
     if not context.args:
-        await update.message.reply_text("Usage: /set_model <model_name>")
+        await safe_reply(update.message, "Usage: /set_model <model_name>")
         return
-    MODEL_NAME = context.args[0]
-    await update.message.reply_text(f"Model changed to: {MODEL_NAME}")
+    update_chat_setting(chat_id, "model", context.args[0])
+    await safe_reply(update.message, f"Model changed to: {context.args[0]}")
+
+async def set_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    try:
+        history_turns = int(context.args[0]) if context.args else -1
+    except ValueError:
+        history_turns = -1
+    if history_turns < 0:
+        await safe_reply(update.message, f"Usage: /set_history <previous turns> (0-{MAX_CONVERSATION_TURNS})")
+        return
+    history_turns = min(history_turns, MAX_CONVERSATION_TURNS)
+    update_chat_setting(chat_id, "history", history_turns)
+    await safe_reply(update.message, f"Prompt history set to {history_turns} turns")
+
+async def cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    if not context.args or context.args[0] not in ("on", "off"):
+        await safe_reply(update.message, "Usage: /cache on|off")
+        return
+    update_chat_setting(chat_id, "cache", context.args[0] == "on")
+    await safe_reply(update.message, f"Response cache {context.args[0]}")
 
 async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
     debug_conversation_structure(chat_id)
-    await update.message.reply_text("Debug info written to logs")
+    await safe_reply(update.message, "Debug info written to logs")
+
+async def post_init(application):
+    """Open the shared Ollama HTTP session once the event loop is running"""
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(keepalive_timeout=OLLAMA_KEEPALIVE),
+        # No overall cap: a long generation is fine as long as tokens keep coming
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=OLLAMA_READ_TIMEOUT)
+    )
+
+async def post_shutdown(application):
+    """Close the shared Ollama HTTP session and write any unsaved conversations"""
+    if http_session is not None:
+        await http_session.close()
+    if save_task is not None:
+        save_task.cancel()
+    await flush_conversations()
+    raw_listener.stop()
 
 def debug_conversation_structure(chat_id):
-    if chat_id not in conversations:
+    if chat_id not in conversations and chat_id not in chat_index:
         logging.info(f"No conversation found for chat_id {chat_id}")
         return
         
-    convo = conversations[chat_id]
+    convo = get_conversation(chat_id)
     logging.info(f"Conversation length: {len(convo)} turns")
     
     for i, turn in enumerate(convo):
@@ -408,13 +1114,41 @@ def debug_conversation_structure(chat_id):
             logging.info(f"Turn {i}: Invalid role: {role}")
 
 if __name__ == "__main__":
+    if not TELEGRAM_BOT_TOKEN:
+        raise SystemExit("Set the TELEGRAM_BOT_TOKEN environment variable")
+
+    # uvloop is optional (and unavailable on Windows); the stock loop works too
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     load_conversations()
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("set_model", set_model_command))
-    application.add_handler(CommandHandler("debug", debug_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("start", start_command, block=False))
+    application.add_handler(CommandHandler("set_model", set_model_command, block=False))
+    application.add_handler(CommandHandler("set_history", set_history_command, block=False))
+    application.add_handler(CommandHandler("cache", cache_command, block=False))
+    application.add_handler(CommandHandler("debug", debug_command, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
 
-    application.run_polling()
\ No newline at end of file
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; the token-derived path keeps the endpoint unguessable
+        url_path = TELEGRAM_BOT_TOKEN.replace(":", "_")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}"
+        )
+    else:
+        application.run_polling()